@@ -1,7 +1,22 @@
 import os
+import re
+import sys
+import struct
+import threading
 import ctypes
 
 libhashpipe = None # set by `load_shared_hashpipe_lib`
+# bound function handles of libhashpipe, set by `load_shared_hashpipe_lib`
+_hp_attach = None
+_hp_detach = None
+_hp_lock = None
+_hp_lock_timeout = None
+_hp_unlock = None
+
+HASHPIPE_STATUS_RECORD_SIZE = 80 # bytes per FITS-style card
+HASHPIPE_STATUS_TOTAL_SIZE = 2304*HASHPIPE_STATUS_RECORD_SIZE # bytes of the status-buffer data area
+_END_RECORD = b"END" + b" "*77
+_RECORD_STRUCT = struct.Struct(f"{HASHPIPE_STATUS_RECORD_SIZE}s")
 
 from rao_keyvalue_property_mixin_classes.guppi_raw import GuppiRawProperties
 from rao_keyvalue_property_mixin_classes.hpdaq_ata import HpdaqAtaProperties
@@ -9,36 +24,235 @@ from rao_keyvalue_property_mixin_classes.hpdaq_cosmic import HpdaqCosmicProperti
 from rao_keyvalue_property_mixin_classes.hpdaq_meerkat import HpdaqMeerkatProperties
 
 
-class HashpipeStatusBufferAta(dict, HpdaqAtaProperties, GuppiRawProperties):
+_NUMBER_RE = re.compile(
+    r"([+-]?\d+)" # int
+    r"|([+-]?(?:\d+\.?\d*|\.\d+)(?:e[+-]?\d+)?|[+-]?(?:nan|inf(?:inity)?))", # float
+    re.IGNORECASE
+)
+
+
+def _decode_number(v: str):
+    m = _NUMBER_RE.fullmatch(v)
+    if m is not None:
+        return int(v) if m.lastindex == 1 else float(v)
+    # forms outside the pattern that int() or float() still accept (e.g. "1_000")
+    try:
+        try:
+            return int(v)
+        except ValueError:
+            return float(v)
+    except ValueError:
+        return v
+
+
+def _decode_quoted(v: str):
+    if v[-1] == "'":
+        # str value, drop enclosing single-quotes
+        return v[1:-1].strip()
+    return v
+
+
+def _decode_bare(v: str):
+    return v
+
+
+# the decoder for a stripped value is selected by the tag of its first character
+_TAG_BARE, _TAG_NUMBER, _TAG_QUOTED = range(3)
+_DECODERS = (_decode_bare, _decode_number, _decode_quoted)
+_VALUE_TAGS = bytes(
+    # non-ASCII first bytes may be the start of a (non-ASCII) digit
+    _TAG_NUMBER if c in b"+-.0123456789nNiI" or c >= 0x80 else _TAG_QUOTED if c == ord("'") else _TAG_BARE
+    for c in range(256)
+)
+
+
+def _decode_value(v: str):
+    v = v.strip()
+    if not v:
+        return v
+    tag = _VALUE_TAGS[ord(v[0])] if v[0].isascii() else _TAG_NUMBER
+    return _DECODERS[tag](v)
+
+
+def _decode_record_value(key: str, value: bytes):
+    # tagged from the raw first byte, so there is no probing of int(), float() or quotes
+    value = value.strip()
+    tag = _VALUE_TAGS[value[0]] if value else _TAG_BARE
+    try:
+        v = value.decode()
+    except UnicodeDecodeError:
+        raise RuntimeError(f"Could not decode: {key.encode() + b'=' + value}")
+    return _DECODERS[tag](v)
+
+
+class HashpipeStatusBuffer(dict):
+    # values of a parsed status buffer are held as the raw bytes of their record and decoded on first access,
+    # buffers constructed from any other mapping hold their values as given
+    _raw_values = False
+
+    def __getitem__(self, key):
+        value = dict.__getitem__(self, key)
+        if self._raw_values and type(value) is bytes:
+            value = _decode_record_value(key, value)
+            dict.__setitem__(self, key, value)
+        return value
+
+    def __iter__(self):
+        # overridden so that dict(self), {**self} etc. fetch values through __getitem__
+        return dict.__iter__(self)
+
+    def _decode_all(self):
+        if self._raw_values:
+            for key in self:
+                self[key]
+
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        return default
+
+    def setdefault(self, key, default=None):
+        if key in self:
+            return self[key]
+        return dict.setdefault(self, key, default)
+
+    def pop(self, key, *default):
+        if key in self:
+            value = self[key]
+            dict.__delitem__(self, key)
+            return value
+        return dict.pop(self, key, *default)
+
+    def popitem(self):
+        key, value = dict.popitem(self)
+        if self._raw_values and type(value) is bytes:
+            try:
+                value = _decode_record_value(key, value)
+            except RuntimeError:
+                # restore the (last) entry rather than losing it
+                dict.__setitem__(self, key, value)
+                raise
+        return key, value
+
+    def values(self):
+        self._decode_all()
+        return dict.values(self)
+
+    def items(self):
+        self._decode_all()
+        return dict.items(self)
+
+    def copy(self):
+        return type(self)(self)
+
+    def __or__(self, other):
+        self._decode_all()
+        return dict.__or__(self, other)
+
+    def __eq__(self, other):
+        self._decode_all()
+        if isinstance(other, HashpipeStatusBuffer):
+            other._decode_all()
+        return dict.__eq__(self, other)
+
+    def __ne__(self, other):
+        eq = self.__eq__(other)
+        return eq if eq is NotImplemented else not eq
+
+    def __repr__(self):
+        self._decode_all()
+        return dict.__repr__(self)
+
+
+class HashpipeStatusBufferAta(HashpipeStatusBuffer, HpdaqAtaProperties, GuppiRawProperties):
     pass
 
 
-class HashpipeStatusBufferCosmic(dict, HpdaqCosmicProperties, GuppiRawProperties):
+class HashpipeStatusBufferCosmic(HashpipeStatusBuffer, HpdaqCosmicProperties, GuppiRawProperties):
     pass
 
 
-class HashpipeStatusBufferMeerkat(dict, HpdaqMeerkatProperties, GuppiRawProperties):
+class HashpipeStatusBufferMeerkat(HashpipeStatusBuffer, HpdaqMeerkatProperties, GuppiRawProperties):
     pass
 
 
+_TELESCOP_CLASS_MAP = {
+    cls.telescope.fget(): cls
+    for cls in [
+        HashpipeStatusBufferAta,
+        HashpipeStatusBufferCosmic,
+        HashpipeStatusBufferMeerkat
+    ]
+}
+# the telescope is the only discriminator, kept in this form for existing users
 PROPERTY_FGET_CLASS_MAP = {
-    GuppiRawProperties.telescope.fget: {
-        cls.telescope.fget(): cls
-        for cls in [
-            HashpipeStatusBufferAta,
-            HashpipeStatusBufferCosmic,
-            HashpipeStatusBufferMeerkat
-        ]
-    }
+    GuppiRawProperties.telescope.fget: _TELESCOP_CLASS_MAP
 }
 
 
 def auto_init_HashpipeStatusBuffer(keyvalues: dict):
-    for property_fget, value_class_map in PROPERTY_FGET_CLASS_MAP.items():
-        property_value = property_fget(keyvalues)
-        if property_value in value_class_map:
-            return value_class_map[property_value](**keyvalues)
-    return keyvalues
+    # the telescope discriminator is the "TELESCOP" key, look it up directly
+    cls = _TELESCOP_CLASS_MAP.get(keyvalues.get("TELESCOP"))
+    if cls is None:
+        return keyvalues
+    return cls(keyvalues)
+
+
+def _init_parsed_HashpipeStatusBuffer(records: dict):
+    # as per `auto_init_HashpipeStatusBuffer`, for the raw record values of `parse_buffer`:
+    # only the discriminator is decoded up front, the rest on access
+    telescop = records.get("TELESCOP")
+    if telescop is not None:
+        telescop = records["TELESCOP"] = _decode_record_value("TELESCOP", telescop)
+    buffer = _TELESCOP_CLASS_MAP.get(telescop, HashpipeStatusBuffer)(records)
+    buffer._raw_values = True
+    return buffer
+
+
+def _scan_cards(raw: bytearray):
+    # tokenize the records preceding the END record into (key, separator, value) bytes triples
+    end = raw.find(_END_RECORD)
+    while end % HASHPIPE_STATUS_RECORD_SIZE != 0:
+        if end < 0:
+            raise RuntimeError("Could not find the END record in the status buffer.")
+        # not record-aligned, so within some value: resume from the next record
+        end = raw.find(_END_RECORD, end - end % HASHPIPE_STATUS_RECORD_SIZE + HASHPIPE_STATUS_RECORD_SIZE)
+    # split the records in use into fixed-width bytes in one pass, the tokens are then hashable bytes
+    return [
+        record.partition(b"=")
+        for (record, ) in _RECORD_STRUCT.iter_unpack(memoryview(raw)[:end])
+    ]
+
+
+# raw key bytes -> interned key str, learnt as keys are first seen
+_KEY_CACHE = {}
+_KEY_CACHE_LIMIT = 4*HASHPIPE_STATUS_TOTAL_SIZE//HASHPIPE_STATUS_RECORD_SIZE
+
+
+def _decode_key(key: bytes, separator: bytes):
+    if not separator:
+        # not a key-value record (e.g. COMMENT or blank), key is then the whole record
+        raise RuntimeError(f"Could not decode: {key}")
+    if len(_KEY_CACHE) >= _KEY_CACHE_LIMIT:
+        _KEY_CACHE.clear()
+    key_str = _KEY_CACHE[key] = sys.intern(key.strip().decode())
+    return key_str
+
+
+def _parse_cards(cards: list):
+    # decode the keys of the (key, separator, value) bytes triples in a single comprehension, leaving the values raw
+    # the same keys recur in every parse, so known keys skip straight to their interned str
+    # (only keys of records with a separator are ever cached)
+    known_key = _KEY_CACHE.get
+    try:
+        return {known_key(key) or _decode_key(key, separator): value for key, separator, value in cards}
+    except UnicodeDecodeError:
+        for key, _, value in cards:
+            try:
+                key.decode()
+            except UnicodeDecodeError:
+                raise RuntimeError(f"Could not decode: {key + b'=' + value}")
+        raise
 
 
 class TimeSpec(ctypes.Structure):
@@ -52,14 +266,17 @@ class HashpipeStatusSharedMemoryIPC(ctypes.Structure):
         ("instance_id", ctypes.c_int), # Instance ID of this status buffer (DO NOT SET/CHANGE!)
         ("shmid", ctypes.c_int), # Shared memory segment id
         ("lock", ctypes.c_void_p), # POSIX semaphore descriptor for locking
-        ("buf", ctypes.POINTER(ctypes.c_char)), # Pointer to data area
+        ("buf", ctypes.c_void_p), # Pointer to data area
     ]
 
     END_RECORD = "END" + " "*77
+    _BUF_ARRAY = ctypes.c_char * HASHPIPE_STATUS_TOTAL_SIZE
 
     def __init__(self, instance_id: int, lock_timeout_s=5):
+        # reusable pointer to self, cast from the address so as to not hold a reference to self
+        self._self_ref = ctypes.cast(ctypes.addressof(self), HashpipeStatusSharedMemoryIPCPointer)
         assert libhashpipe is not None, f"libhashpipe.so has not been loaded, set 'HASHPIPE_SO_PATH' before importing, or call load_shared_hashpipe_lib before instantiating an instance of HashpipeStatus."
-        rv = libhashpipe.hashpipe_status_attach(instance_id, ctypes.byref(self))
+        rv = _hp_attach(instance_id, self._self_ref)
         if rv != 0:
             raise RuntimeError(f"Failed to connect to status buffer of instance {instance_id}")
         self.lock_timeout_timespec: TimeSpec = None
@@ -67,98 +284,113 @@ class HashpipeStatusSharedMemoryIPC(ctypes.Structure):
             self.lock_timeout_timespec = TimeSpec()
             self.lock_timeout_timespec.tv_sec = int(lock_timeout_s)
             self.lock_timeout_timespec.tv_nsec = int((lock_timeout_s%1)*1e9)
+        # reused by each parse_buffer call, guarded so that threads sharing an instance don't overwrite each other's copy
+        self._scratch = bytearray(HASHPIPE_STATUS_TOTAL_SIZE)
+        self._scratch_array = self._BUF_ARRAY.from_buffer(self._scratch)
+        self._scratch_lock = threading.Lock()
+
 
+    @property
+    def lock_timeout_timespec(self) -> TimeSpec:
+        return self._lock_timeout_timespec
+
+    @lock_timeout_timespec.setter
+    def lock_timeout_timespec(self, timespec: TimeSpec):
+        # keep the reference passed to hashpipe_status_lock_timeout in step with the timespec
+        self._lock_timeout_timespec = timespec
+        self._lock_timeout_ref = None if timespec is None else ctypes.byref(timespec)
 
     def __del__(self):
         if libhashpipe is None:
             return
-        rv = libhashpipe.hashpipe_status_detach(ctypes.byref(self))
+        rv = _hp_detach(self._self_ref)
         if rv != 0:
             raise RuntimeError(f"Failed to detach from status buffer of instance {self.instance_id}")
 
-    @staticmethod
-    def _decode_value(v: str):
-        try:
-            try:
-                return int(v)
-            except ValueError:
-                return float(v)
-        except ValueError:
-            # must be a str value, drop enclosing single-quotes
-            v = v.strip()
-            if v[0] == v[-1] == "'":
-                return v[1:-1].strip()
-        return v
+    _decode_value = staticmethod(_decode_value)
 
     def parse_buffer(self):
-        keyvalues = {}
-        with self:
-            i = 0
-            while True:
-                record = self.buf[i:i+80]
-                try:
-                    record = record.decode()
-                except:
-                    raise RuntimeError(f"Could not decode: {record}")
-                if record == self.END_RECORD:
-                    break
-                key, value = record.split("=", maxsplit=1)
-                keyvalues[key.strip()] = self._decode_value(value)
-                i += 80
-        return auto_init_HashpipeStatusBuffer(keyvalues)
+        # only hold the status lock for a single copy of the whole data area, and the scratch lock
+        # until the records in use have been copied out of it, parse those copies afterwards
+        with self._scratch_lock:
+            self.acquire()
+            try:
+                ctypes.memmove(self._scratch_array, self.buf, HASHPIPE_STATUS_TOTAL_SIZE)
+            finally:
+                self.release()
+            cards = _scan_cards(self._scratch)
+        return _init_parsed_HashpipeStatusBuffer(_parse_cards(cards))
 
-    def __enter__(self):
+    def acquire(self):
         if self.lock_timeout_timespec is None:
-            libhashpipe.hashpipe_status_lock(ctypes.byref(self))
+            _hp_lock(self._self_ref)
         else:
-            rv = libhashpipe.hashpipe_status_lock_timeout(ctypes.byref(self), ctypes.byref(self.lock_timeout_timespec))
+            rv = _hp_lock_timeout(self._self_ref, self._lock_timeout_ref)
             if rv != 0:
                 timeout_s = self.lock_timeout_timespec.tv_sec + self.lock_timeout_timespec.tv_nsec*1e-9
                 raise RuntimeWarning(f"Timeout ({timeout_s} s) reached while locking status buffer.")
 
+    def release(self):
+        _hp_unlock(self._self_ref)
+
+    def __enter__(self):
+        self.acquire()
+
     def __exit__(self, *args):
-        libhashpipe.hashpipe_status_unlock(ctypes.byref(self))
+        self.release()
 
 HashpipeStatusSharedMemoryIPCPointer = ctypes.POINTER(HashpipeStatusSharedMemoryIPC)
 TimeSpecPointer = ctypes.POINTER(TimeSpec)
 
 def load_shared_hashpipe_lib(lib_so_path):
-    global libhashpipe
+    global libhashpipe, _hp_attach, _hp_detach, _hp_lock, _hp_lock_timeout, _hp_unlock
     libhashpipe = ctypes.CDLL(lib_so_path)
 
     libhashpipe.hashpipe_status_key.argtypes = (ctypes.c_int, )
-    libhashpipe.hashpipe_status_key.restypes = ctypes.c_int
+    libhashpipe.hashpipe_status_key.restype = ctypes.c_int
 
     libhashpipe.hashpipe_status_attach.argtypes = (ctypes.c_int, HashpipeStatusSharedMemoryIPCPointer)
-    libhashpipe.hashpipe_status_attach.restypes = ctypes.c_int
+    libhashpipe.hashpipe_status_attach.restype = ctypes.c_int
 
     libhashpipe.hashpipe_databuf_key.argtypes = (ctypes.c_int, )
-    libhashpipe.hashpipe_databuf_key.restypes = ctypes.c_int
+    libhashpipe.hashpipe_databuf_key.restype = ctypes.c_int
 
     libhashpipe.hashpipe_status_detach.argtypes = (HashpipeStatusSharedMemoryIPCPointer, )
-    libhashpipe.hashpipe_status_detach.restypes = ctypes.c_int
+    libhashpipe.hashpipe_status_detach.restype = ctypes.c_int
 
     libhashpipe.hashpipe_status_lock.argtypes = (HashpipeStatusSharedMemoryIPCPointer,)
+    libhashpipe.hashpipe_status_lock.restype = ctypes.c_int
     libhashpipe.hashpipe_status_lock_timeout.argtypes = (HashpipeStatusSharedMemoryIPCPointer, TimeSpecPointer)
-    libhashpipe.hashpipe_status_lock_timeout.restypes = ctypes.c_int
+    libhashpipe.hashpipe_status_lock_timeout.restype = ctypes.c_int
     libhashpipe.hashpipe_status_unlock.argtypes = (HashpipeStatusSharedMemoryIPCPointer, )
+    libhashpipe.hashpipe_status_unlock.restype = ctypes.c_int
 
-if (so_path := os.getenv("HASHPIPE_SO_PATH", None)) is not None:
-    load_shared_hashpipe_lib(so_path)
-elif (ld_library_path := os.getenv("LD_LIBRARY_PATH", None)) is not None:
-    libfilename = os.getenv("HASHPIPE_SO_FILENAME", "libhashpipe.so")
+    _hp_attach = libhashpipe.hashpipe_status_attach
+    _hp_detach = libhashpipe.hashpipe_status_detach
+    _hp_lock = libhashpipe.hashpipe_status_lock
+    _hp_lock_timeout = libhashpipe.hashpipe_status_lock_timeout
+    _hp_unlock = libhashpipe.hashpipe_status_unlock
+
+def _find_shared_lib(ld_library_path, libfilename):
+    # a single stat per directory, which also skips broken symlinks
     for lib_dirpath in ld_library_path.split(":"):
         if len(lib_dirpath) == 0:
             continue
-        
+
         path = os.path.join(lib_dirpath, libfilename)
         if os.path.exists(path):
-            load_shared_hashpipe_lib(path)
-            break
+            return path
+    return None
+
+if (so_path := os.getenv("HASHPIPE_SO_PATH", None)) is not None:
+    load_shared_hashpipe_lib(so_path)
+elif (ld_library_path := os.getenv("LD_LIBRARY_PATH", None)) is not None:
+    libfilename = os.getenv("HASHPIPE_SO_FILENAME", "libhashpipe.so")
+    if (path := _find_shared_lib(ld_library_path, libfilename)) is not None:
+        load_shared_hashpipe_lib(path)
 
 
 if __name__ == "__main__":
-    import sys
     if len(sys.argv) > 1:
         load_shared_hashpipe_lib(sys.argv[-1])
     hs = HashpipeStatusSharedMemoryIPC(0)